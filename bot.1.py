@@ -1,8 +1,27 @@
+import io
 import os
+import re
+import sys
+import gzip
+import json
+import shutil
+import signal
+import asyncio
+import cProfile
+import pstats
+import threading
+import traceback
+from bisect import bisect_left, insort
+from collections import deque
+import time
+import hashlib
 import sqlite3
-from datetime import datetime, timezone, timedelta, time as dtime
+from typing import Callable
+from datetime import datetime, timezone, timedelta, time as dtime, tzinfo
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import discord
+from aiohttp import web
 from discord import app_commands
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
@@ -12,11 +31,16 @@ from dotenv import load_dotenv
 # =======================
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN", "")
-if not TOKEN:
+# أدوات الباك أب تشتغل بدون توكن: python bot.1.py --restore backups/staff_duty-....db.gz
+CLI_MODE = len(sys.argv) > 1 and sys.argv[1] in ("--restore", "--verify-backup")
+if not TOKEN and not CLI_MODE:
     raise SystemExit("❌ حط DISCORD_TOKEN داخل .env")
 
-# Riyadh fixed offset (Saudi no DST)
+# Riyadh fixed offset (Saudi no DST) — fallback لو tzdata مو موجودة
 RIYADH_TZ = timezone(timedelta(hours=3))
+DEFAULT_TZ_NAME = "Asia/Riyadh"
+DEFAULT_REPORT_WEEKDAY = 4  # Friday (Monday=0)
+DEFAULT_REPORT_HOUR = 20
 
 # =======================
 # INTENTS
@@ -31,7 +55,13 @@ intents.voice_states = True
 # لو فعلته خله True هنا:
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class StaffBot(commands.Bot):
+    async def close(self):
+        # الإحصائيات اللي بالطابور/الذاكرة تنكتب قبل ما نطفي
+        await stop_ingest_worker()
+        await super().close()
+
+bot = StaffBot(command_prefix="!", intents=intents)
 
 # =======================
 # DB
@@ -49,6 +79,9 @@ def add_column_if_missing(con, table: str, col: str, col_type: str):
 
 def init_db():
     with db() as con:
+        # WAL: القراءة (API/لوحة) ما تنتظر كتابة الإحصائيات
+        con.execute("PRAGMA journal_mode=WAL")
+
         # settings
         con.execute("""
         CREATE TABLE IF NOT EXISTS settings (
@@ -60,7 +93,13 @@ def init_db():
             staff_week_role_id INTEGER DEFAULT 0,
             alert_channel_id INTEGER DEFAULT 0,
             auto_out_hours INTEGER DEFAULT 6,
-            last_weekly_key TEXT DEFAULT ''
+            last_weekly_key TEXT DEFAULT '',
+            tz_name TEXT DEFAULT 'Asia/Riyadh',
+            report_weekday INTEGER DEFAULT 4,
+            report_hour INTEGER DEFAULT 20,
+            msg_rate_per_min INTEGER DEFAULT 12,
+            msg_burst INTEGER DEFAULT 6,
+            dup_window_sec INTEGER DEFAULT 30
         )
         """)
 
@@ -70,6 +109,12 @@ def init_db():
         add_column_if_missing(con, "settings", "alert_channel_id", "INTEGER DEFAULT 0")
         add_column_if_missing(con, "settings", "auto_out_hours", "INTEGER DEFAULT 6")
         add_column_if_missing(con, "settings", "last_weekly_key", "TEXT DEFAULT ''")
+        add_column_if_missing(con, "settings", "tz_name", "TEXT DEFAULT 'Asia/Riyadh'")
+        add_column_if_missing(con, "settings", "report_weekday", "INTEGER DEFAULT 4")
+        add_column_if_missing(con, "settings", "report_hour", "INTEGER DEFAULT 20")
+        add_column_if_missing(con, "settings", "msg_rate_per_min", "INTEGER DEFAULT 12")
+        add_column_if_missing(con, "settings", "msg_burst", "INTEGER DEFAULT 6")
+        add_column_if_missing(con, "settings", "dup_window_sec", "INTEGER DEFAULT 30")
 
         # active duty includes shift
         con.execute("""
@@ -97,6 +142,18 @@ def init_db():
         )
         """)
         add_column_if_missing(con, "duty_sessions", "shift", "TEXT NOT NULL DEFAULT 'Support'")
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_duty_sessions_user ON duty_sessions (guild_id, user_id, start_ts)"
+        )
+
+        # posted dashboard panels (كلها تتحدث مع بعض)
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS duty_panels (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER PRIMARY KEY
+        )
+        """)
 
         # message stats daily
         con.execute("""
@@ -133,35 +190,87 @@ def init_db():
 
         con.commit()
 
+# guild_id -> settings row (الإعدادات ما تتغير إلا عن طريق set_setting)
+_settings_cache: dict[int, dict] = {}
+
 def ensure_guild(guild_id: int):
     with db() as con:
         con.execute("INSERT OR IGNORE INTO settings (guild_id) VALUES (?)", (guild_id,))
         con.commit()
 
 def get_settings(guild_id: int) -> dict:
+    cached = _settings_cache.get(guild_id)
+    if cached is not None:
+        return cached
     ensure_guild(guild_id)
     with db() as con:
         cur = con.execute("SELECT * FROM settings WHERE guild_id=?", (guild_id,))
         row = cur.fetchone()
         cols = [d[0] for d in cur.description]
-    return dict(zip(cols, row))
+    s = dict(zip(cols, row))
+    _settings_cache[guild_id] = s
+    return s
 
 def set_setting(guild_id: int, key: str, value):
     ensure_guild(guild_id)
     with db() as con:
         con.execute(f"UPDATE settings SET {key}=? WHERE guild_id=?", (value, guild_id))
         con.commit()
+    _settings_cache.pop(guild_id, None)
+    _tz_cache.pop(guild_id, None)
+    _day_cache.pop(guild_id, None)
+    api_invalidate(guild_id)
+    dash_invalidate(guild_id)
 
 def now_ts() -> int:
-    return int(datetime.now(timezone.utc).timestamp())
+    return int(time.time())
 
-def riyadh_now() -> datetime:
-    return datetime.now(RIYADH_TZ)
+# =======================
+# Per-guild timezone / day keys
+# =======================
+WEEKDAYS_AR = ["الاثنين", "الثلاثاء", "الأربعاء", "الخميس", "الجمعة", "السبت", "الأحد"]
 
-def day_key_riyadh(dt: datetime | None = None) -> str:
-    if dt is None:
-        dt = riyadh_now()
-    return dt.strftime("%Y-%m-%d")  # based on Riyadh date
+# guild_id -> tzinfo
+_tz_cache: dict[int, tzinfo] = {}
+# guild_id -> (day_start_ts, day_end_ts, day_key) لليوم الحالي بتوقيت السيرفر
+_day_cache: dict[int, tuple[int, int, str]] = {}
+
+def load_tz(name: str) -> tzinfo | None:
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+def guild_tz(guild_id: int) -> tzinfo:
+    tz = _tz_cache.get(guild_id)
+    if tz is None:
+        name = str(get_settings(guild_id).get("tz_name") or DEFAULT_TZ_NAME)
+        tz = load_tz(name) or RIYADH_TZ
+        _tz_cache[guild_id] = tz
+    return tz
+
+def guild_now(guild_id: int) -> datetime:
+    return datetime.now(guild_tz(guild_id))
+
+def guild_day_key(guild_id: int, ts: int | None = None) -> str:
+    # hot path: مقارنة أرقام فقط، ونحسب حدود اليوم من جديد بس لما يتغير اليوم
+    if ts is None:
+        ts = now_ts()
+    hit = _day_cache.get(guild_id)
+    if hit and hit[0] <= ts < hit[1]:
+        return hit[2]
+
+    tz = guild_tz(guild_id)
+    day = datetime.fromtimestamp(ts, tz).date()
+    start = datetime.combine(day, dtime(0), tzinfo=tz)
+    end = datetime.combine(day + timedelta(days=1), dtime(0), tzinfo=tz)
+    entry = (int(start.timestamp()), int(end.timestamp()), day.strftime("%Y-%m-%d"))
+    _day_cache[guild_id] = entry
+    return entry[2]
+
+def guild_since_day(guild_id: int, days: int) -> str:
+    # day_key قبل (days) يوم بتوقيت السيرفر
+    return (guild_now(guild_id) - timedelta(days=days)).strftime("%Y-%m-%d")
 
 def fmt_duration(seconds: int) -> str:
     if seconds < 0:
@@ -188,8 +297,9 @@ def get_roles(guild: discord.Guild):
 def is_staff_member(member: discord.Member, staff_role: discord.Role | None) -> bool:
     return bool(staff_role and staff_role in member.roles)
 
-def is_onduty(member: discord.Member, onduty_role: discord.Role | None) -> bool:
-    return bool(onduty_role and onduty_role in member.roles)
+def is_onduty(member: discord.Member) -> bool:
+    # duty_state هو المرجع، مو الرتبة
+    return member.id in duty_state.get(member.guild.id, {})
 
 async def send_log(guild: discord.Guild, text: str):
     s = get_settings(guild.id)
@@ -201,41 +311,77 @@ async def send_log(guild: discord.Guild, text: str):
         await ch.send(text)
 
 # =======================
-# Duty DB
+# Duty state (in-memory + DB)
 # =======================
-def set_active_duty(guild_id: int, user_id: int, start_ts: int, shift: str):
+# guild_id -> {user_id: (start_ts, shift)}
+# نسخة الذاكرة من active_duty: تنحمل مرة عند التشغيل، وكل انتقال يكتب DB بعملية وحدة ثم يحدثها.
+# الانتقالات لازم تكون داخل duty_lock(guild_id, user_id).
+duty_state: dict[int, dict[int, tuple[int, str]]] = {}
+_duty_locks: dict[tuple[int, int], asyncio.Lock] = {}
+
+def load_duty_state():
+    duty_state.clear()
     with db() as con:
-        con.execute(
-            "INSERT OR REPLACE INTO active_duty (guild_id, user_id, start_ts, shift) VALUES (?,?,?,?)",
-            (guild_id, user_id, start_ts, shift),
-        )
-        con.commit()
+        cur = con.execute("SELECT guild_id, user_id, start_ts, shift FROM active_duty")
+        for gid, uid, st, sh in cur.fetchall():
+            duty_state.setdefault(int(gid), {})[int(uid)] = (int(st), str(sh))
+
+def duty_lock(guild_id: int, user_id: int) -> asyncio.Lock:
+    key = (guild_id, user_id)
+    lock = _duty_locks.get(key)
+    if lock is None:
+        lock = _duty_locks[key] = asyncio.Lock()
+    return lock
 
 def get_active_duty(guild_id: int, user_id: int):
-    with db() as con:
-        cur = con.execute(
-            "SELECT start_ts, shift FROM active_duty WHERE guild_id=? AND user_id=?",
-            (guild_id, user_id),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        return int(row[0]), str(row[1])
+    return duty_state.get(guild_id, {}).get(user_id)
 
-def clear_active_duty(guild_id: int, user_id: int):
+def duty_open(guild_id: int, user_id: int, start_ts: int, shift: str) -> bool:
+    if get_active_duty(guild_id, user_id):
+        return False
     with db() as con:
-        con.execute("DELETE FROM active_duty WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+        con.execute(
+            "INSERT OR REPLACE INTO active_duty (guild_id, user_id, start_ts, shift) VALUES (?,?,?,?)",
+            (guild_id, user_id, start_ts, shift),
+        )
         con.commit()
-
-def add_duty_session(guild_id: int, user_id: int, start_ts: int, end_ts: int, shift: str) -> int:
+    duty_state.setdefault(guild_id, {})[user_id] = (start_ts, shift)
+    api_invalidate(guild_id)
+    dash_on_open(guild_id, user_id, shift)
+    return True
+
+def duty_close(guild_id: int, user_id: int, end_ts: int):
+    # returns (start_ts, shift, duration_sec) or None — الجلسة + حذف active_duty بنفس الـ transaction
+    active = get_active_duty(guild_id, user_id)
+    if not active:
+        return None
+    start_ts, shift = active
     dur = max(0, end_ts - start_ts)
     with db() as con:
         con.execute(
             "INSERT INTO duty_sessions (guild_id, user_id, start_ts, end_ts, duration_sec, shift) VALUES (?,?,?,?,?,?)",
             (guild_id, user_id, start_ts, end_ts, dur, shift),
         )
+        con.execute("DELETE FROM active_duty WHERE guild_id=? AND user_id=?", (guild_id, user_id))
         con.commit()
-    return dur
+    duty_state[guild_id].pop(user_id, None)
+    api_invalidate(guild_id)
+    dash_on_close(guild_id, user_id)
+    user_stats_invalidate(guild_id, user_id)
+    return start_ts, shift, dur
+
+def duty_drop(guild_id: int, user_id: int):
+    # بدون جلسة (العضو طلع من السيرفر)
+    with db() as con:
+        con.execute("DELETE FROM active_duty WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+        con.commit()
+    duty_state.get(guild_id, {}).pop(user_id, None)
+    api_invalidate(guild_id)
+    dash_on_close(guild_id, user_id)
+
+# =======================
+# Duty DB
+# =======================
 
 def duty_weekly_totals(guild_id: int, since_ts: int):
     # returns dict user_id -> (total_sec, sessions_count)
@@ -255,20 +401,74 @@ def duty_weekly_totals(guild_id: int, since_ts: int):
         return out
 
 # =======================
-# Message stats
+# Per-user duty stats (cached)
 # =======================
-def inc_msg(guild_id: int, user_id: int, day_key: str):
+USER_STATS_TTL = 60
+USER_STATS_MAX_SESSIONS = 500  # أقصى عدد جلسات نعرضها بالتاريخ
+STATS_PERIODS = {"week": 7, "month": 30, "all": 0}
+
+# (guild_id, user_id, period) -> (expires_at, stats)
+_user_stats_cache: dict[tuple[int, int, str], tuple[float, dict]] = {}
+
+def user_stats_invalidate(guild_id: int, user_id: int):
+    for period in STATS_PERIODS:
+        _user_stats_cache.pop((guild_id, user_id, period), None)
+
+def user_duty_stats(guild_id: int, user_id: int, period: str) -> dict:
+    key = (guild_id, user_id, period)
+    hit = _user_stats_cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+
+    days = STATS_PERIODS[period]
+    since_ts = now_ts() - days * 24 * 3600 if days else 0
     with db() as con:
-        con.execute(
+        # الاستعلامين يمشون على idx_duty_sessions_user
+        cur = con.execute(
+            """
+            SELECT shift, SUM(duration_sec), COUNT(*)
+            FROM duty_sessions
+            WHERE guild_id=? AND user_id=? AND start_ts>=?
+            GROUP BY shift
+            """,
+            (guild_id, user_id, since_ts),
+        )
+        by_shift = {str(sh): (int(total or 0), int(n or 0)) for sh, total, n in cur.fetchall()}
+        cur = con.execute(
             """
-            INSERT INTO msg_daily (guild_id, user_id, day_key, count)
-            VALUES (?,?,?,1)
-            ON CONFLICT(guild_id, user_id, day_key)
-            DO UPDATE SET count=count+1
+            SELECT start_ts, end_ts, duration_sec, shift
+            FROM duty_sessions
+            WHERE guild_id=? AND user_id=? AND start_ts>=?
+            ORDER BY start_ts DESC
+            LIMIT ?
             """,
-            (guild_id, user_id, day_key),
+            (guild_id, user_id, since_ts, USER_STATS_MAX_SESSIONS),
         )
-        con.commit()
+        sessions = [(int(st), int(en), int(dur), str(sh)) for st, en, dur, sh in cur.fetchall()]
+
+    stats = {
+        "by_shift": by_shift,
+        "total_sec": sum(t for t, _ in by_shift.values()),
+        "count": sum(n for _, n in by_shift.values()),
+        "sessions": sessions,
+    }
+    _user_stats_cache[key] = (time.monotonic() + USER_STATS_TTL, stats)
+    return stats
+
+# =======================
+# Message stats
+# =======================
+def inc_msg_many(con, counts: dict):
+    # counts: (guild_id, user_id, day_key) -> n
+    con.executemany(
+        """
+        INSERT INTO msg_daily (guild_id, user_id, day_key, count)
+        VALUES (?,?,?,?)
+        ON CONFLICT(guild_id, user_id, day_key)
+        DO UPDATE SET count=count+excluded.count
+        """,
+        [(g, u, dk, n) for (g, u, dk), n in counts.items()],
+    )
 
 def msg_weekly_total(guild_id: int, since_day_key: str):
     # since_day_key inclusive, day_key is YYYY-MM-DD
@@ -287,41 +487,36 @@ def msg_weekly_total(guild_id: int, since_day_key: str):
 # =======================
 # Voice stats
 # =======================
-def voice_join(guild_id: int, user_id: int, join_ts: int):
-    with db() as con:
-        # mark active
-        con.execute(
-            "INSERT OR REPLACE INTO voice_active (guild_id, user_id, join_ts) VALUES (?,?,?)",
-            (guild_id, user_id, join_ts),
-        )
-        con.commit()
+def voice_join(con, guild_id: int, user_id: int, join_ts: int):
+    # mark active
+    con.execute(
+        "INSERT OR REPLACE INTO voice_active (guild_id, user_id, join_ts) VALUES (?,?,?)",
+        (guild_id, user_id, join_ts),
+    )
 
-def voice_leave(guild_id: int, user_id: int, leave_ts: int):
-    with db() as con:
-        cur = con.execute(
-            "SELECT join_ts FROM voice_active WHERE guild_id=? AND user_id=?",
-            (guild_id, user_id),
-        )
-        row = cur.fetchone()
-        if not row:
-            return 0
-        join_ts = int(row[0])
-        con.execute("DELETE FROM voice_active WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-
-        # add to daily voice totals (based on Riyadh day when leaving)
-        dur = max(0, leave_ts - join_ts)
-        dk = day_key_riyadh()
-        con.execute(
-            """
-            INSERT INTO voice_daily (guild_id, user_id, day_key, voice_sec, joins)
-            VALUES (?,?,?,?,1)
-            ON CONFLICT(guild_id, user_id, day_key)
-            DO UPDATE SET voice_sec=voice_sec+excluded.voice_sec, joins=joins+1
-            """,
-            (guild_id, user_id, dk, dur),
-        )
-        con.commit()
-        return dur
+def voice_leave(con, guild_id: int, user_id: int, leave_ts: int, day_key: str):
+    cur = con.execute(
+        "SELECT join_ts FROM voice_active WHERE guild_id=? AND user_id=?",
+        (guild_id, user_id),
+    )
+    row = cur.fetchone()
+    if not row:
+        return 0
+    join_ts = int(row[0])
+    con.execute("DELETE FROM voice_active WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+
+    # add to daily voice totals (based on guild's day when leaving)
+    dur = max(0, leave_ts - join_ts)
+    con.execute(
+        """
+        INSERT INTO voice_daily (guild_id, user_id, day_key, voice_sec, joins)
+        VALUES (?,?,?,?,1)
+        ON CONFLICT(guild_id, user_id, day_key)
+        DO UPDATE SET voice_sec=voice_sec+excluded.voice_sec, joins=joins+1
+        """,
+        (guild_id, user_id, day_key, dur),
+    )
+    return dur
 
 def voice_weekly_total(guild_id: int, since_day_key: str):
     with db() as con:
@@ -336,51 +531,287 @@ def voice_weekly_total(guild_id: int, since_day_key: str):
         )
         return {int(uid): (int(vsec or 0), int(joins or 0)) for uid, vsec, joins in cur.fetchall()}
 
+# =======================
+# Paged view (◀️/▶️)
+# =======================
+class PagedView(discord.ui.View):
+    # render(page) يرجع embed الصفحة
+    def __init__(self, page_count: int, render: Callable[[int], discord.Embed]):
+        super().__init__(timeout=120)
+        self.page = 0
+        self.page_count = max(1, page_count)
+        self.render = render
+        self._sync_buttons()
+
+    def _sync_buttons(self):
+        self.prev_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def _show(self, inter: discord.Interaction):
+        self._sync_buttons()
+        await inter.response.edit_message(embed=self.render(self.page), view=self)
+
+    @discord.ui.button(label="◀️", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, inter: discord.Interaction, button: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await self._show(inter)
+
+    @discord.ui.button(label="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, inter: discord.Interaction, button: discord.ui.Button):
+        self.page = min(self.page_count - 1, self.page + 1)
+        await self._show(inter)
+
 # =======================
 # Dashboard Embed
 # =======================
 SHIFTS = ["Support", "Chat", "Patrol"]
 
-def build_dashboard_embed(guild: discord.Guild) -> discord.Embed:
-    staff_role, onduty_role, staff_week_role = get_roles(guild)
+PANEL_REFRESH_DELAY = 2.0      # نجمع التغييرات المتتالية بتحديث واحد لكل اللوحات
+MESSAGE_CHAR_LIMIT = 6000      # مجموع كل الـ embeds في رسالة وحدة
+FIELD_CHAR_LIMIT = 1024
+LIST_PAGE_SIZE = 40
+
+# guild_id -> {shift: [(sort_key, user_id)]} مرتبة، تتحدث مع كل دخول/خروج/تغيير اسم
+_dash_lists: dict[int, dict[str, list[tuple[str, int]]]] = {}
+# guild_id -> {user_id: (shift, sort_key)}
+_dash_entries: dict[int, dict[int, tuple[str, str]]] = {}
+# guild_id -> embeds جاهزة (مشتركة بين كل اللوحات)
+_dash_cache: dict[int, list[discord.Embed]] = {}
+# guild_id -> {(channel_id, message_id)}
+_panels: dict[int, set[tuple[int, int]]] = {}
+_panel_refresh_tasks: dict[int, asyncio.Task] = {}
+
+def dash_sort_key(guild_id: int, user_id: int) -> str:
+    guild = bot.get_guild(guild_id)
+    member = guild.get_member(user_id) if guild else None
+    return member.display_name.lower() if member else str(user_id)
+
+def dash_lists(guild_id: int) -> dict:
+    lists = _dash_lists.get(guild_id)
+    if lists is None:
+        lists = {sh: [] for sh in SHIFTS}
+        entries = {}
+        for uid, (_, sh) in duty_state.get(guild_id, {}).items():
+            sh = sh if sh in lists else "Support"
+            key = dash_sort_key(guild_id, uid)
+            lists[sh].append((key, uid))
+            entries[uid] = (sh, key)
+        for lst in lists.values():
+            lst.sort()
+        _dash_lists[guild_id] = lists
+        _dash_entries[guild_id] = entries
+    return lists
+
+def _dash_add(guild_id: int, user_id: int, shift: str):
+    lists = _dash_lists.get(guild_id)
+    if lists is None:
+        return  # تنبني كاملة أول ما تنطلب
+    sh = shift if shift in lists else "Support"
+    key = dash_sort_key(guild_id, user_id)
+    insort(lists[sh], (key, user_id))
+    _dash_entries[guild_id][user_id] = (sh, key)
+
+def _dash_remove(guild_id: int, user_id: int) -> str | None:
+    lists = _dash_lists.get(guild_id)
+    if lists is None:
+        return None
+    entry = _dash_entries[guild_id].pop(user_id, None)
+    if entry is None:
+        return None
+    sh, key = entry
+    lst = lists[sh]
+    i = bisect_left(lst, (key, user_id))
+    if i < len(lst) and lst[i] == (key, user_id):
+        del lst[i]
+    return sh
+
+def dash_on_open(guild_id: int, user_id: int, shift: str):
+    _dash_add(guild_id, user_id, shift)
+    dash_invalidate(guild_id)
+
+def dash_on_close(guild_id: int, user_id: int):
+    _dash_remove(guild_id, user_id)
+    dash_invalidate(guild_id)
+
+def dash_on_rename(guild_id: int, user_id: int):
+    sh = _dash_remove(guild_id, user_id)
+    if sh is None:
+        return
+    _dash_add(guild_id, user_id, sh)
+    dash_invalidate(guild_id)
 
-    # build lists by shift from active_duty table
+def dash_invalidate(guild_id: int):
+    _dash_cache.pop(guild_id, None)
+    schedule_panel_refresh(guild_id)
+
+def onduty_by_shift(guild: discord.Guild, onduty_role: discord.Role | None) -> dict:
+    # shift -> [member] مرتبة بالاسم
     shift_map = {s: [] for s in SHIFTS}
     if onduty_role:
-        with db() as con:
-            cur = con.execute("SELECT user_id, shift FROM active_duty WHERE guild_id=?", (guild.id,))
-            for uid, sh in cur.fetchall():
-                member = guild.get_member(int(uid))
-                if member and not member.bot and onduty_role in member.roles:
-                    sh = sh if sh in shift_map else "Support"
+        for sh, lst in dash_lists(guild.id).items():
+            for _, uid in lst:
+                member = guild.get_member(uid)
+                if member and not member.bot:
                     shift_map[sh].append(member)
-
-    for sh in SHIFTS:
-        shift_map[sh].sort(key=lambda m: m.display_name.lower())
+    return shift_map
+
+def fair_budgets(needs: list[int], total: int) -> list[int]:
+    # نقسم المساحة بالتساوي، واللي يحتاج أقل يعطي الباقي للي بعده
+    budgets = [0] * len(needs)
+    left = total
+    order = sorted(range(len(needs)), key=lambda i: needs[i])
+    for n, i in enumerate(order):
+        share = left // (len(needs) - n)
+        budgets[i] = min(needs[i], share)
+        left -= budgets[i]
+    return budgets
+
+def build_dashboard_embeds(guild: discord.Guild) -> list[discord.Embed]:
+    staff_role, onduty_role, staff_week_role = get_roles(guild)
+    lists = dash_lists(guild.id) if onduty_role else {sh: [] for sh in SHIFTS}
+    total = sum(len(lst) for lst in lists.values())
 
     e = discord.Embed(
         title="🛡️ لوحة حضور الإدارة",
         description="✅ دخول يفتح اختيار شفت (Support/Chat/Patrol)\n"
                     "🛑 خروج يشيل OnDuty\n"
-                    "🚨 طوارئ ينبه OnDuty",
+                    "🚨 طوارئ ينبه OnDuty\n"
+                    "📋 القائمة تعرض كل المتواجدين بصفحات",
     )
     e.add_field(name="👤 Staff (شكل فقط)", value=staff_role.mention if staff_role else "غير محددة", inline=True)
     e.add_field(name="⚡ OnDuty (صلاحيات)", value=onduty_role.mention if onduty_role else "غير محددة", inline=True)
     e.add_field(name="🏆 Staff of the Week", value=staff_week_role.mention if staff_week_role else "غير محددة", inline=True)
+    footer = f"🔄 تحديث يعيد تحديث القائمة | 👥 {total} مداوم"
+    embeds = [e]
+
+    # embed لكل شفت، وكلها تتقاسم حد الـ 6000 حرف للرسالة
+    shift_lines = {sh: [f"🟢 <@{uid}>" for _, uid in lists[sh]] for sh in SHIFTS}
+    reserve = 120  # عنوان الشفت + أسماء الحقول + سطر "… (+N)"
+    room = MESSAGE_CHAR_LIMIT - len(e) - len(footer) - reserve * len(SHIFTS)
+    needs = [sum(len(line) + 1 for line in shift_lines[sh]) for sh in SHIFTS]
+    budgets = fair_budgets(needs, max(0, room))
+
+    for sh, budget in zip(SHIFTS, budgets):
+        lines = shift_lines[sh]
+        se = discord.Embed(title=f"📌 المتواجدين الآن — {sh} ({len(lines)})")
+        if not lines:
+            se.description = "—"
+            embeds.append(se)
+            continue
 
-    # show per shift
-    for sh in SHIFTS:
-        members = shift_map[sh]
-        if members:
-            text = "\n".join([f"🟢 {m.mention}" for m in members[:20]])
-            if len(members) > 20:
-                text += f"\n… (+{len(members)-20})"
-        else:
-            text = "—"
-        e.add_field(name=f"📌 المتواجدين الآن — {sh}", value=text, inline=False)
+        shown, used = [], 0
+        for line in lines:
+            if used + len(line) + 1 > budget:
+                break
+            shown.append(line)
+            used += len(line) + 1
+
+        chunks, cur, size = [], [], 0
+        for line in shown:
+            if cur and size + len(line) + 1 > FIELD_CHAR_LIMIT:
+                chunks.append(cur)
+                cur, size = [], 0
+            cur.append(line)
+            size += len(line) + 1
+        if cur:
+            chunks.append(cur)
+
+        for i, chunk in enumerate(chunks, start=1):
+            se.add_field(name=f"{i}/{len(chunks)}" if len(chunks) > 1 else "\u200b", value="\n".join(chunk), inline=True)
+        if len(shown) < len(lines):
+            se.add_field(name="\u200b", value=f"… (+{len(lines) - len(shown)}) — اضغط 📋 القائمة", inline=False)
+        embeds.append(se)
+
+    embeds[-1].set_footer(text=footer)
+    return embeds
+
+def dashboard_embeds(guild: discord.Guild) -> list[discord.Embed]:
+    embeds = _dash_cache.get(guild.id)
+    if embeds is None:
+        embeds = _dash_cache[guild.id] = build_dashboard_embeds(guild)
+    return embeds
+
+def build_member_list_pages(guild: discord.Guild) -> list[discord.Embed]:
+    pages = []
+    for sh, lst in dash_lists(guild.id).items():
+        for start in range(0, len(lst), LIST_PAGE_SIZE):
+            chunk = lst[start:start + LIST_PAGE_SIZE]
+            pages.append(discord.Embed(
+                title=f"📋 {sh} ({len(lst)})",
+                description="\n".join(f"🟢 <@{uid}>" for _, uid in chunk),
+            ))
+    if not pages:
+        pages.append(discord.Embed(title="📋 المتواجدين الآن", description="—"))
+    for i, page in enumerate(pages, start=1):
+        page.set_footer(text=f"صفحة {i}/{len(pages)}")
+    return pages
 
-    e.set_footer(text="🔄 تحديث يعيد تحديث القائمة")
-    return e
+# =======================
+# Dashboard panels (كل اللوحات المنشورة)
+# =======================
+def load_panels():
+    _panels.clear()
+    with db() as con:
+        cur = con.execute("SELECT guild_id, channel_id, message_id FROM duty_panels")
+        for gid, ch_id, msg_id in cur.fetchall():
+            _panels.setdefault(int(gid), set()).add((int(ch_id), int(msg_id)))
+
+def remember_panel(guild_id: int, channel_id: int, message_id: int):
+    panels = _panels.setdefault(guild_id, set())
+    if (channel_id, message_id) in panels:
+        return
+    with db() as con:
+        con.execute(
+            "INSERT OR REPLACE INTO duty_panels (guild_id, channel_id, message_id) VALUES (?,?,?)",
+            (guild_id, channel_id, message_id),
+        )
+        con.commit()
+    panels.add((channel_id, message_id))
+
+def forget_panel(guild_id: int, channel_id: int, message_id: int):
+    with db() as con:
+        con.execute("DELETE FROM duty_panels WHERE message_id=?", (message_id,))
+        con.commit()
+    _panels.get(guild_id, set()).discard((channel_id, message_id))
+
+async def refresh_panels(guild: discord.Guild):
+    embeds = dashboard_embeds(guild)
+    for channel_id, message_id in list(_panels.get(guild.id, ())):
+        ch = guild.get_channel(channel_id)
+        if not isinstance(ch, discord.TextChannel):
+            forget_panel(guild.id, channel_id, message_id)
+            continue
+        try:
+            # نرسل الـ view كمان عشان اللوحات القديمة تاخذ الأزرار الجديدة (custom_ids ثابتة)
+            await ch.get_partial_message(message_id).edit(embeds=embeds, view=DutyPanelView())
+        except discord.NotFound:
+            forget_panel(guild.id, channel_id, message_id)
+        except discord.HTTPException as e:
+            print(f"❌ Panel refresh failed ({channel_id}/{message_id}):", e)
+
+async def _delayed_panel_refresh(guild_id: int):
+    await asyncio.sleep(PANEL_REFRESH_DELAY)
+    # نشيل المهمة قبل التحديث عشان أي تغيير أثناءه يجدول تحديث جديد
+    _panel_refresh_tasks.pop(guild_id, None)
+    guild = bot.get_guild(guild_id)
+    if guild:
+        await refresh_panels(guild)
+
+def schedule_panel_refresh(guild_id: int):
+    if not _panels.get(guild_id):
+        return
+    task = _panel_refresh_tasks.get(guild_id)
+    if task and not task.done():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _panel_refresh_tasks[guild_id] = loop.create_task(_delayed_panel_refresh(guild_id))
+
+class MemberListView(PagedView):
+    def __init__(self, pages: list[discord.Embed]):
+        super().__init__(len(pages), pages.__getitem__)
 
 # =======================
 # Emergency Modal
@@ -457,6 +888,12 @@ class DutyPanelView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)
 
+    async def interaction_check(self, inter: discord.Interaction) -> bool:
+        # اللوحات القديمة (قبل جدول duty_panels) تنسجل أول ما أحد يضغط عليها
+        if inter.guild and inter.message:
+            remember_panel(inter.guild.id, inter.message.channel.id, inter.message.id)
+        return True
+
     async def _guard_staff(self, inter: discord.Interaction):
         if not inter.guild:
             await inter.response.send_message("داخل سيرفر فقط.", ephemeral=True)
@@ -481,16 +918,17 @@ class DutyPanelView(discord.ui.View):
         _, onduty_role = roles
         member: discord.Member = inter.user  # type: ignore
 
-        if is_onduty(member, onduty_role):
-            return await inter.followup.send("أنت أصلًا **مداوم** ✅", ephemeral=True)
-
+        # القفل وتعديل الرتبة ممكن يتأخرون، فنرد على التفاعل قبل (حد الـ 3 ثواني)
+        await inter.response.defer(ephemeral=True)
         try:
-            await member.add_roles(onduty_role, reason="Duty IN")
-            start = now_ts()
-            set_active_duty(inter.guild.id, member.id, start, shift)
+            async with duty_lock(inter.guild.id, member.id):
+                if is_onduty(member):
+                    return await inter.followup.send("أنت أصلًا **مداوم** ✅", ephemeral=True)
+                await member.add_roles(onduty_role, reason="Duty IN")
+                start = now_ts()
+                duty_open(inter.guild.id, member.id, start, shift)
             await send_log(inter.guild, f"🟢 **Duty IN**: {member} | shift={shift} | <t:{start}:t>")
-            # تحديث اللوحة
-            await inter.message.edit(embed=build_dashboard_embed(inter.guild), view=self)
+            # اللوحات تتحدث من duty_open (schedule_panel_refresh)
             await inter.followup.send(f"✅ تم تسجيل دخولك (OnDuty) — **{shift}** 🟢", ephemeral=True)
         except discord.Forbidden:
             await inter.followup.send("❌ ما عندي صلاحية أعدل الرتب. ارفع رتبة البوت وفعل Manage Roles.", ephemeral=True)
@@ -501,8 +939,7 @@ class DutyPanelView(discord.ui.View):
         if not roles:
             return
         member: discord.Member = inter.user  # type: ignore
-        staff_role, onduty_role = roles
-        if is_onduty(member, onduty_role):
+        if is_onduty(member):
             return await inter.response.send_message("أنت أصلًا **مداوم** ✅", ephemeral=True)
 
         # افتح اختيار الشفت بشكل Ephemeral
@@ -520,26 +957,20 @@ class DutyPanelView(discord.ui.View):
         _, onduty_role = roles
         member: discord.Member = inter.user  # type: ignore
 
-        if not is_onduty(member, onduty_role):
-            return await inter.response.send_message("أنت أصلًا **مو مداوم** 💤", ephemeral=True)
-
+        # القفل وتعديل الرتبة ممكن يتأخرون، فنرد على التفاعل قبل (حد الـ 3 ثواني)
+        await inter.response.defer(ephemeral=True)
         try:
-            await member.remove_roles(onduty_role, reason="Duty OUT")
-            end = now_ts()
-            active = get_active_duty(inter.guild.id, member.id)
-            if active:
-                start, shift = active
-            else:
-                start, shift = end, "Support"
-
-            dur = add_duty_session(inter.guild.id, member.id, start, end, shift)
-            clear_active_duty(inter.guild.id, member.id)
+            async with duty_lock(inter.guild.id, member.id):
+                if not is_onduty(member):
+                    return await inter.followup.send("أنت أصلًا **مو مداوم** 💤", ephemeral=True)
+                if onduty_role in member.roles:
+                    await member.remove_roles(onduty_role, reason="Duty OUT")
+                _, shift, dur = duty_close(inter.guild.id, member.id, now_ts())
 
             await send_log(inter.guild, f"🔴 **Duty OUT**: {member} | shift={shift} | مدة: **{fmt_duration(dur)}**")
-            await inter.message.edit(embed=build_dashboard_embed(inter.guild), view=self)
-            await inter.response.send_message(f"🛑 تم تسجيل خروجك. دوامك: **{fmt_duration(dur)}**", ephemeral=True)
+            await inter.followup.send(f"🛑 تم تسجيل خروجك. دوامك: **{fmt_duration(dur)}**", ephemeral=True)
         except discord.Forbidden:
-            await inter.response.send_message("❌ ما عندي صلاحية أعدل الرتب. ارفع رتبة البوت وفعل Manage Roles.", ephemeral=True)
+            await inter.followup.send("❌ ما عندي صلاحية أعدل الرتب. ارفع رتبة البوت وفعل Manage Roles.", ephemeral=True)
 
     @discord.ui.button(label="🚨 طوارئ", style=discord.ButtonStyle.primary, custom_id="duty_emergency_btn")
     async def emergency(self, inter: discord.Interaction, button: discord.ui.Button):
@@ -563,9 +994,311 @@ class DutyPanelView(discord.ui.View):
         if not (is_admin(inter) or is_staff_member(member, staff_role)):
             return await inter.response.send_message("❌ التحديث للستاف فقط.", ephemeral=True)
 
-        await inter.message.edit(embed=build_dashboard_embed(inter.guild), view=self)
+        # يمر على نفس الـ debounce، فالضغط المتكرر = تحديث واحد لكل لوحة
+        dash_invalidate(inter.guild.id)
         await inter.response.send_message("🔄 تم تحديث لوحة الحضور.", ephemeral=True)
 
+    @discord.ui.button(label="📋 القائمة", style=discord.ButtonStyle.secondary, custom_id="duty_list_btn")
+    async def member_list(self, inter: discord.Interaction, button: discord.ui.Button):
+        if not inter.guild:
+            return await inter.response.send_message("داخل سيرفر فقط.", ephemeral=True)
+
+        staff_role, _, _ = get_roles(inter.guild)
+        member: discord.Member = inter.user  # type: ignore
+        if not (is_admin(inter) or is_staff_member(member, staff_role)):
+            return await inter.response.send_message("❌ للستاف فقط.", ephemeral=True)
+
+        pages = build_member_list_pages(inter.guild)
+        await inter.response.send_message(
+            embed=pages[0],
+            view=MemberListView(pages) if len(pages) > 1 else discord.utils.MISSING,
+            ephemeral=True,
+        )
+
+# =======================
+# Per-user stats view
+# =======================
+STATS_PAGE_SIZE = 10
+PERIOD_LABELS = {"week": "آخر 7 أيام", "month": "آخر 30 يوم", "all": "كل الوقت"}
+
+def build_user_stats_embed(member: discord.Member, period: str, stats: dict, page: int) -> discord.Embed:
+    sessions = stats["sessions"]
+    pages = max(1, (len(sessions) + STATS_PAGE_SIZE - 1) // STATS_PAGE_SIZE)
+
+    e = discord.Embed(
+        title=f"📊 إحصائيات الدوام — {member.display_name}",
+        description=f"🗓️ {PERIOD_LABELS[period]} | ⏱️ المجموع: **{fmt_duration(stats['total_sec'])}** | 🧾 {stats['count']} جلسة",
+    )
+    active = get_active_duty(member.guild.id, member.id)
+    if active:
+        e.description += f"\n🟢 مداوم الحين ({active[1]}) من <t:{active[0]}:R>"
+
+    for sh in SHIFTS:
+        sec, n = stats["by_shift"].get(sh, (0, 0))
+        e.add_field(name=f"📌 {sh}", value=f"{fmt_duration(sec)} ({n})", inline=True)
+
+    chunk = sessions[page * STATS_PAGE_SIZE:(page + 1) * STATS_PAGE_SIZE]
+    if chunk:
+        lines = [
+            f"<t:{st}:d> <t:{st}:t> → <t:{en}:t> | {sh} | **{fmt_duration(dur)}**"
+            for st, en, dur, sh in chunk
+        ]
+        e.add_field(name="🧾 الجلسات", value="\n".join(lines), inline=False)
+    else:
+        e.add_field(name="🧾 الجلسات", value="—", inline=False)
+
+    e.set_footer(text=f"صفحة {page + 1}/{pages}")
+    return e
+
+class UserStatsView(PagedView):
+    def __init__(self, member: discord.Member, period: str, stats: dict):
+        super().__init__(
+            (len(stats["sessions"]) + STATS_PAGE_SIZE - 1) // STATS_PAGE_SIZE,
+            lambda page: build_user_stats_embed(member, period, stats, page),
+        )
+
+async def send_user_stats(inter: discord.Interaction, member: discord.Member, period: str):
+    stats = user_duty_stats(inter.guild.id, member.id, period)
+    view = UserStatsView(member, period, stats)
+    await inter.response.send_message(
+        embed=build_user_stats_embed(member, period, stats, 0),
+        view=view if view.page_count > 1 else discord.utils.MISSING,
+        ephemeral=True,
+    )
+
+# =======================
+# Stats ingestion (bounded queue)
+# =======================
+# الإحصائيات (رسائل/فويس) تروح لطابور محدود ويكتبها worker واحد بدفعات في thread،
+# عشان أزرار اللوحة والدوام (كتابة مباشرة) ما تنتظر خلف عدّ الرسائل.
+INGEST_QUEUE_MAX = int(os.getenv("INGEST_QUEUE_MAX", "5000"))
+INGEST_HIGH_WATER = INGEST_QUEUE_MAX * 3 // 4   # فوقها: الرسائل تتجمع بالذاكرة بدل الطابور
+INGEST_LOW_WATER = INGEST_QUEUE_MAX // 4        # تحتها: نرجع للوضع الطبيعي
+INGEST_BATCH = 500
+INGEST_FLUSH_SEC = 1.0
+INGEST_RETRY_MIN_SEC = 0.5   # لو فشلت الكتابة نعيد نفس الدفعة بـ backoff
+INGEST_RETRY_MAX_SEC = 30.0
+
+ingest_queue: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_MAX)
+ingest_degraded = False
+# (guild_id, user_id, day_key) -> count (وضع الضغط)
+_msg_pending: dict[tuple[int, int, str], int] = {}
+_ingest_task: asyncio.Task | None = None
+_ingest_stopping = False
+# دفعة فشلت وإحنا نطفي: تنضاف لآخر flush
+_ingest_leftover: list = []
+
+ingest_metrics = {
+    "enqueued": 0,
+    "aggregated": 0,
+    "written": 0,
+    "batches": 0,
+    "max_depth": 0,
+    "degraded_count": 0,
+    "retries": 0,
+    "last_batch_ms": 0.0,
+}
+
+def ingest_set_degraded(on: bool):
+    global ingest_degraded
+    if ingest_degraded == on:
+        return
+    ingest_degraded = on
+    if on:
+        ingest_metrics["degraded_count"] += 1
+        print(f"⚠️ Ingest degraded: queue={ingest_queue.qsize()} — message counts aggregated in memory")
+    else:
+        print(f"✅ Ingest recovered: queue={ingest_queue.qsize()}")
+
+def ingest_msg(guild_id: int, user_id: int, day_key: str):
+    depth = ingest_queue.qsize()
+    if depth > ingest_metrics["max_depth"]:
+        ingest_metrics["max_depth"] = depth
+    if depth >= INGEST_HIGH_WATER:
+        ingest_set_degraded(True)
+
+    if ingest_degraded:
+        key = (guild_id, user_id, day_key)
+        _msg_pending[key] = _msg_pending.get(key, 0) + 1
+        ingest_metrics["aggregated"] += 1
+        return
+
+    ingest_queue.put_nowait(("msg", guild_id, user_id, day_key))
+    ingest_metrics["enqueued"] += 1
+
+async def ingest_voice(kind: str, guild_id: int, user_id: int, ts: int):
+    # الفويس ما ينرمى: لو الطابور مليان ننتظر (يتأخر هذا الحدث بس)
+    await ingest_queue.put((kind, guild_id, user_id, ts, guild_day_key(guild_id, ts)))
+    ingest_metrics["enqueued"] += 1
+
+def write_ingest_batch(items: list, pending: dict):
+    # ما نعدل pending عشان لو فشلت الدفعة (rollback) نقدر نعيدها كما هي
+    msg_counts = dict(pending)
+    with db() as con:
+        for item in items:
+            if item[0] == "msg":
+                key = item[1:]
+                msg_counts[key] = msg_counts.get(key, 0) + 1
+            elif item[0] == "vjoin":
+                voice_join(con, item[1], item[2], item[3])
+            elif item[0] == "vleave":
+                voice_leave(con, item[1], item[2], item[3], item[4])
+        if msg_counts:
+            inc_msg_many(con, msg_counts)
+        con.commit()
+
+async def ingest_worker():
+    while not _ingest_stopping:
+        items = []
+        try:
+            items.append(await asyncio.wait_for(ingest_queue.get(), timeout=INGEST_FLUSH_SEC))
+        except asyncio.TimeoutError:
+            pass
+        while items and len(items) < INGEST_BATCH and not ingest_queue.empty():
+            items.append(ingest_queue.get_nowait())
+
+        if ingest_degraded and ingest_queue.qsize() <= INGEST_LOW_WATER:
+            ingest_set_degraded(False)
+
+        msg_counts = _msg_pending.copy()
+        _msg_pending.clear()
+        if not items and not msg_counts:
+            continue
+
+        # الدفعة ما تنرمى: نعيدها لين تنكتب. وإحنا ننتظر، الطابور يمتلي
+        # فالرسائل تتجمع بـ _msg_pending والفويس ينتظر مكان (backpressure)
+        delay = INGEST_RETRY_MIN_SEC
+        written = False
+        while True:
+            t0 = time.perf_counter()
+            try:
+                await asyncio.to_thread(call_profiled, write_ingest_batch, items, msg_counts)
+                written = True
+                break
+            except Exception as e:
+                ingest_metrics["retries"] += 1
+                if _ingest_stopping:
+                    print("❌ Ingest batch error while stopping, left for final flush:", e)
+                    break
+                print(f"❌ Ingest batch error (retry in {delay:.1f}s):", e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, INGEST_RETRY_MAX_SEC)
+
+        if not written:
+            _ingest_leftover.extend(items)
+            for key, n in msg_counts.items():
+                _msg_pending[key] = _msg_pending.get(key, 0) + n
+            for _ in items:
+                ingest_queue.task_done()
+            break
+
+        ingest_metrics["written"] += len(items)
+        ingest_metrics["batches"] += 1
+        ingest_metrics["last_batch_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        for _ in items:
+            ingest_queue.task_done()
+
+def start_ingest_worker():
+    global _ingest_task
+    if _ingest_task is None or _ingest_task.done():
+        _ingest_task = asyncio.create_task(ingest_worker())
+
+async def stop_ingest_worker():
+    # نوقف الـ worker (يخلص دفعته الحالية)، وبعدين نكتب كل اللي باقي بدفعة وحدة
+    global _ingest_stopping
+    _ingest_stopping = True
+    if _ingest_task is not None and not _ingest_task.done():
+        await _ingest_task
+
+    items = _ingest_leftover[:]
+    _ingest_leftover.clear()
+    while not ingest_queue.empty():
+        items.append(ingest_queue.get_nowait())
+        ingest_queue.task_done()
+    msg_counts = _msg_pending.copy()
+    _msg_pending.clear()
+    if not items and not msg_counts:
+        return
+    try:
+        await asyncio.to_thread(write_ingest_batch, items, msg_counts)
+        print(f"💾 Ingest flushed on shutdown: {len(items)} events + {len(msg_counts)} aggregated counts")
+    except Exception as e:
+        print("❌ Ingest flush on shutdown failed:", e)
+
+def ingest_snapshot() -> dict:
+    return {
+        **ingest_metrics,
+        "depth": ingest_queue.qsize(),
+        "max_size": INGEST_QUEUE_MAX,
+        "degraded": ingest_degraded,
+        "pending_keys": len(_msg_pending),
+    }
+
+# =======================
+# Spam filter (before counting)
+# =======================
+DUP_HISTORY = 3           # نقارن مع آخر كم رسالة
+MSG_BUCKET_IDLE_SEC = 600  # نشيل bucket اللي ما كتب من 10 دقايق (أو أكثر لو dup_window أطول)
+_REPEAT_RE = re.compile(r"(.)\1+")
+
+# (guild_id, user_id) -> [tokens, last_refill_ts, deque[(fingerprint, ts)], last_seen_ts]
+_msg_buckets: dict[tuple[int, int], list] = {}
+spam_metrics = {"counted": 0, "throttled": 0, "duplicates": 0}
+
+def content_fingerprint(text: str) -> int | None:
+    # near-duplicate: بدون مسافات/رموز/حروف مكررة ("Hiii!!" == "hi")
+    t = "".join(ch for ch in text.lower() if ch.isalnum())
+    if not t:
+        return None
+    return hash(_REPEAT_RE.sub(r"\1", t))
+
+def should_count_message(guild_id: int, user_id: int, content: str) -> bool:
+    s = get_settings(guild_id)
+    rate = int(s.get("msg_rate_per_min") or 0)   # 0 = بدون حد
+    burst = max(1, int(s.get("msg_burst") or 1))
+    window = int(s.get("dup_window_sec") or 0)   # 0 = بدون فلتر تكرار
+    nowm = time.monotonic()
+
+    key = (guild_id, user_id)
+    b = _msg_buckets.get(key)
+    if b is None:
+        b = _msg_buckets[key] = [float(burst), nowm, deque(maxlen=DUP_HISTORY), nowm]
+    b[3] = nowm  # حتى المكرر يحسب نشاط، عشان الـ GC ما يمسح تاريخ التكرار
+
+    if window > 0:
+        fp = content_fingerprint(content)
+        if fp is not None:
+            for old_fp, old_ts in b[2]:
+                if old_fp == fp and nowm - old_ts <= window:
+                    spam_metrics["duplicates"] += 1
+                    return False
+            b[2].append((fp, nowm))
+
+    if rate > 0:
+        tokens = min(float(burst), b[0] + (nowm - b[1]) * rate / 60)
+        b[1] = nowm
+        if tokens < 1:
+            b[0] = tokens
+            spam_metrics["throttled"] += 1
+            return False
+        b[0] = tokens - 1
+    else:
+        b[1] = nowm
+
+    spam_metrics["counted"] += 1
+    return True
+
+@tasks.loop(minutes=10)
+async def msg_bucket_gc():
+    nowm = time.monotonic()
+    stale = []
+    for key, b in _msg_buckets.items():
+        window = int(get_settings(key[0]).get("dup_window_sec") or 0)
+        if nowm - b[3] > max(MSG_BUCKET_IDLE_SEC, window):
+            stale.append(key)
+    for key in stale:
+        del _msg_buckets[key]
+
 # =======================
 # Event: Count messages
 # =======================
@@ -573,8 +1306,9 @@ class DutyPanelView(discord.ui.View):
 async def on_message(message: discord.Message):
     if not message.guild or message.author.bot:
         return
-    dk = day_key_riyadh()
-    inc_msg(message.guild.id, message.author.id, dk)
+    if should_count_message(message.guild.id, message.author.id, message.content):
+        dk = guild_day_key(message.guild.id)
+        ingest_msg(message.guild.id, message.author.id, dk)
     await bot.process_commands(message)  # ما يضر حتى لو ما عندك أوامر prefix
 
 # =======================
@@ -587,18 +1321,90 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
 
     # join voice
     if before.channel is None and after.channel is not None:
-        voice_join(member.guild.id, member.id, now_ts())
+        await ingest_voice("vjoin", member.guild.id, member.id, now_ts())
         return
 
     # leave voice
     if before.channel is not None and after.channel is None:
-        voice_leave(member.guild.id, member.id, now_ts())
+        await ingest_voice("vleave", member.guild.id, member.id, now_ts())
         return
 
     # move between channels -> treat as leave+join (counts as join)
     if before.channel is not None and after.channel is not None and before.channel.id != after.channel.id:
-        voice_leave(member.guild.id, member.id, now_ts())
-        voice_join(member.guild.id, member.id, now_ts())
+        ts = now_ts()
+        await ingest_voice("vleave", member.guild.id, member.id, ts)
+        await ingest_voice("vjoin", member.guild.id, member.id, ts)
+
+# =======================
+# Event: OnDuty role changed by hand
+# =======================
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if after.bot:
+        return
+    if before.display_name != after.display_name:
+        dash_on_rename(after.guild.id, after.id)
+        if is_onduty(after):
+            api_invalidate(after.guild.id)  # "onduty" فيها display_name
+    _, onduty_role, _ = get_roles(after.guild)
+    if not onduty_role:
+        return
+    if (onduty_role in before.roles) == (onduty_role in after.roles):
+        return
+
+    # البوت نفسه يغير الرتبة وهو ماسك القفل، فلما نوصل هنا الحالة تكون متطابقة ولا نسوي شي
+    async with duty_lock(after.guild.id, after.id):
+        has_role = onduty_role in after.roles
+        if has_role and not is_onduty(after):
+            start = now_ts()
+            duty_open(after.guild.id, after.id, start, "Support")
+            opened, closed = True, None
+        elif not has_role and is_onduty(after):
+            opened, closed = False, duty_close(after.guild.id, after.id, now_ts())
+        else:
+            return
+
+    if opened:
+        await send_log(after.guild, f"🟢 **Duty IN (role)**: {after} | shift=Support | <t:{start}:t>")
+    elif closed:
+        _, shift, dur = closed
+        await send_log(after.guild, f"🔴 **Duty OUT (role)**: {after} | shift={shift} | مدة: **{fmt_duration(dur)}**")
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    # طلع من السيرفر وهو مداوم: نقفل جلسته الحين بدل ما يظل باللوحة لين auto clockout
+    # (نفحص قبل القفل عشان ما ننشئ قفل لكل عضو يطلع)
+    if not is_onduty(member):
+        return
+    async with duty_lock(member.guild.id, member.id):
+        closed = duty_close(member.guild.id, member.id, now_ts()) if is_onduty(member) else None
+    if closed:
+        _, shift, dur = closed
+        await send_log(member.guild, f"🔴 **Duty OUT (left)**: {member} | shift={shift} | مدة: **{fmt_duration(dur)}**")
+
+async def reconcile_duty_roles(guild: discord.Guild):
+    # بعد التشغيل: اللي تغيرت رتبته والبوت طافي
+    _, onduty_role, _ = get_roles(guild)
+    if not onduty_role:
+        return
+    holders = {m.id for m in onduty_role.members if not m.bot}
+    active = set(duty_state.get(guild.id, {}))
+    limit_sec = int(get_settings(guild.id).get("auto_out_hours", 6) or 6) * 3600
+
+    for uid in holders - active:
+        async with duty_lock(guild.id, uid):
+            duty_open(guild.id, uid, now_ts(), "Support")
+    for uid in active - holders:
+        async with duty_lock(guild.id, uid):
+            if not get_active_duty(guild.id, uid):
+                continue  # انقفلت وإحنا ننتظر القفل
+            member = guild.get_member(uid)
+            if member is None:
+                duty_drop(guild.id, uid)  # طلع والبوت طافي، ما نعرف متى (مثل auto clockout)
+            elif onduty_role not in member.roles:
+                # ما نعرف متى انشالت الرتبة: ما نحسب أكثر من حد auto clockout
+                start_ts_, _ = get_active_duty(guild.id, uid)
+                duty_close(guild.id, uid, min(now_ts(), start_ts_ + limit_sec))
 
 # =======================
 # Auto clockout
@@ -614,33 +1420,34 @@ async def auto_clockout_loop():
         if not onduty_role:
             continue
 
-        # pull actives
-        with db() as con:
-            cur = con.execute("SELECT user_id, start_ts, shift FROM active_duty WHERE guild_id=?", (guild.id,))
-            actives = [(int(uid), int(st), str(sh)) for uid, st, sh in cur.fetchall()]
+        # snapshot actives
+        actives = list(duty_state.get(guild.id, {}).items())
 
         nowu = now_ts()
-        for uid, start_ts_, shift in actives:
+        for uid, (start_ts_, _) in actives:
             if nowu - start_ts_ < limit_sec:
                 continue
 
-            member = guild.get_member(uid)
-            if not member:
-                clear_active_duty(guild.id, uid)
-                continue
+            async with duty_lock(guild.id, uid):
+                active = get_active_duty(guild.id, uid)
+                if not active or active[0] != start_ts_:
+                    continue  # تغيرت الحالة وإحنا ننتظر القفل
 
-            # remove onduty
-            try:
-                if onduty_role in member.roles:
-                    await member.remove_roles(onduty_role, reason="Auto clock-out")
-            except discord.Forbidden:
-                # لو ما قدر، على الأقل نسجل
-                await send_log(guild, f"⚠️ Auto clockout failed (no perms) for {member}")
-                continue
+                member = guild.get_member(uid)
+                if not member:
+                    duty_drop(guild.id, uid)
+                    continue
 
-            end = nowu
-            dur = add_duty_session(guild.id, uid, start_ts_, end, shift)
-            clear_active_duty(guild.id, uid)
+                # remove onduty
+                try:
+                    if onduty_role in member.roles:
+                        await member.remove_roles(onduty_role, reason="Auto clock-out")
+                except discord.Forbidden:
+                    # لو ما قدر، على الأقل نسجل
+                    await send_log(guild, f"⚠️ Auto clockout failed (no perms) for {member}")
+                    continue
+
+                _, shift, dur = duty_close(guild.id, uid, nowu)
 
             await send_log(guild, f"⏲️ **Auto Clock-Out**: {member} | shift={shift} | مدة: **{fmt_duration(dur)}** (limit {max_hours}h)")
 
@@ -662,6 +1469,29 @@ def points(duty_sec: int, msg_count: int, voice_sec: int, voice_joins: int, sess
         + (sessions * 2)
     )
 
+def weekly_rows(guild_id: int) -> list:
+    # returns [(uid, pts, duty_sec, sessions, msg_count, voice_sec, voice_joins)] sorted by pts
+    since_ts = now_ts() - 7 * 24 * 3600
+    since_day = guild_since_day(guild_id, 6)  # آخر 7 أيام شامل اليوم
+
+    duty_map = duty_weekly_totals(guild_id, since_ts)        # uid -> (sec, sessions)
+    msg_map = msg_weekly_total(guild_id, since_day)          # uid -> msg
+    voice_map = voice_weekly_total(guild_id, since_day)      # uid -> (sec, joins)
+
+    # اجمع كل IDs
+    all_ids = set(duty_map.keys()) | set(msg_map.keys()) | set(voice_map.keys())
+
+    rows = []
+    for uid in all_ids:
+        duty_sec, sessions = duty_map.get(uid, (0, 0))
+        msg_count = msg_map.get(uid, 0)
+        vsec, vjoins = voice_map.get(uid, (0, 0))
+        p = points(duty_sec, msg_count, vsec, vjoins, sessions)
+        rows.append((uid, p, duty_sec, sessions, msg_count, vsec, vjoins))
+
+    rows.sort(key=lambda x: x[1], reverse=True)
+    return rows
+
 async def run_weekly_report_for_guild(guild: discord.Guild):
     s = get_settings(guild.id)
     weekly_channel_id = int(s["weekly_channel_id"] or 0)
@@ -675,30 +1505,12 @@ async def run_weekly_report_for_guild(guild: discord.Guild):
     if not isinstance(channel, discord.TextChannel) or not staff_week_role:
         return
 
-    since_ts = now_ts() - 7 * 24 * 3600
-    since_day = (riyadh_now() - timedelta(days=6)).strftime("%Y-%m-%d")  # آخر 7 أيام شامل اليوم
-
-    duty_map = duty_weekly_totals(guild.id, since_ts)        # uid -> (sec, sessions)
-    msg_map = msg_weekly_total(guild.id, since_day)          # uid -> msg
-    voice_map = voice_weekly_total(guild.id, since_day)      # uid -> (sec, joins)
-
-    # اجمع كل IDs
-    all_ids = set(duty_map.keys()) | set(msg_map.keys()) | set(voice_map.keys())
-    if not all_ids:
+    rows = weekly_rows(guild.id)
+    if not rows:
         embed = discord.Embed(title="📊 تقرير حضور الإدارة الأسبوعي", description="ما فيه بيانات هذا الأسبوع.")
         await channel.send(embed=embed)
         return
 
-    rows = []
-    for uid in all_ids:
-        duty_sec, sessions = duty_map.get(uid, (0, 0))
-        msg_count = msg_map.get(uid, 0)
-        vsec, vjoins = voice_map.get(uid, (0, 0))
-        p = points(duty_sec, msg_count, vsec, vjoins, sessions)
-        rows.append((uid, p, duty_sec, sessions, msg_count, vsec, vjoins))
-
-    rows.sort(key=lambda x: x[1], reverse=True)
-
     embed = discord.Embed(
         title="📊 تقرير الإدارة الأسبوعي (متقدم)",
         description="آخر 7 أيام — يعتمد على (دوام + رسائل + فويس + دخول فويس + عدد الشفتات)."
@@ -730,18 +1542,18 @@ async def run_weekly_report_for_guild(guild: discord.Guild):
 
     await channel.send(embed=embed)
 
-# scheduler: run Friday 20:00 Riyadh, once per date key
+# scheduler: run at each guild's report day/hour (default Friday 20:00 Riyadh), once per date key
 @tasks.loop(minutes=1)
 async def weekly_scheduler():
-    now = riyadh_now()
-    if now.weekday() != 4:  # Friday
-        return
-    if not (now.hour == 20 and now.minute == 0):
-        return
-
-    week_key = now.strftime("%Y-%m-%d")
     for guild in bot.guilds:
         s = get_settings(guild.id)
+        now = guild_now(guild.id)
+        if now.weekday() != int(s.get("report_weekday", DEFAULT_REPORT_WEEKDAY)):
+            continue
+        if now.hour != int(s.get("report_hour", DEFAULT_REPORT_HOUR)):
+            continue
+
+        week_key = now.strftime("%Y-%m-%d")
         last_key = str(s.get("last_weekly_key") or "")
         if last_key == week_key:
             continue
@@ -751,6 +1563,346 @@ async def weekly_scheduler():
         except Exception:
             pass
 
+# =======================
+# HTTP API (read-only)
+# =======================
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8080") or 0)  # 0 = مقفل
+API_STATS_TTL = 60  # الترتيب يتغير مع كل رسالة/فويس، نعيد بناءه مرة بالدقيقة كحد أقصى
+
+# (guild_id, key) -> (etag, body, built_at)
+_api_cache: dict[tuple[int, str], tuple[str, bytes, float]] = {}
+# guild_id -> {user_id: (rank, row)} من نفس بناء "leaderboard" (عشان /users ما يلمس DB)
+_api_ranks: dict[int, dict[int, tuple[int, tuple]]] = {}
+_api_runner: web.AppRunner | None = None
+
+def api_invalidate(guild_id: int):
+    # أي تغيير بالدوام/الإعدادات يمسح كاش السيرفر كامل (يتبنى من جديد أول طلب)
+    for key in [k for k in _api_cache if k[0] == guild_id]:
+        del _api_cache[key]
+    _api_ranks.pop(guild_id, None)
+
+def api_entry(payload: dict):
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return etag, body, time.monotonic()
+
+def api_cached(guild_id: int, key: str, build, ttl: float | None = None):
+    hit = _api_cache.get((guild_id, key))
+    if hit and (ttl is None or time.monotonic() - hit[2] < ttl):
+        return hit
+    entry = api_entry(build())
+    _api_cache[(guild_id, key)] = entry
+    return entry
+
+def api_response(request: web.Request, entry) -> web.Response:
+    etag, body, _ = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    inm = request.headers.get("If-None-Match", "")
+    tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+    if "*" in tags or etag in tags:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+
+def api_guild(request: web.Request) -> discord.Guild:
+    try:
+        guild = bot.get_guild(int(request.match_info["guild_id"]))
+    except ValueError:
+        guild = None
+    if guild is None:
+        raise web.HTTPNotFound(text='{"error":"guild not found"}', content_type="application/json")
+    return guild
+
+def api_onduty_payload(guild: discord.Guild) -> dict:
+    _, onduty_role, _ = get_roles(guild)
+    shift_map = onduty_by_shift(guild, onduty_role)
+    return {
+        "guild_id": guild.id,
+        "shifts": {
+            sh: [{"id": m.id, "name": m.display_name} for m in members]
+            for sh, members in shift_map.items()
+        },
+    }
+
+def api_row(row) -> dict:
+    uid, p, duty_sec, sessions, msg_count, vsec, vjoins = row
+    return {
+        "user_id": uid, "points": p, "duty_sec": duty_sec, "sessions": sessions,
+        "messages": msg_count, "voice_sec": vsec, "voice_joins": vjoins,
+    }
+
+def api_leaderboard_payload(guild: discord.Guild) -> dict:
+    rows = weekly_rows(guild.id)
+    _api_ranks[guild.id] = {row[0]: (rank, row) for rank, row in enumerate(rows, start=1)}
+    return {"guild_id": guild.id, "days": 7, "rows": [api_row(r) for r in rows]}
+
+def api_user_payload(guild: discord.Guild, user_id: int) -> dict:
+    # يعتمد على آخر بناء للـ leaderboard (api_user يتأكد إنه جديد قبل)
+    hit = _api_ranks.get(guild.id, {}).get(user_id)
+    if hit:
+        rank, row = hit
+        return {"guild_id": guild.id, "days": 7, "rank": rank, **api_row(row)}
+    return {"guild_id": guild.id, "days": 7, "rank": None, **api_row((user_id, 0, 0, 0, 0, 0, 0))}
+
+async def api_onduty(request: web.Request):
+    guild = api_guild(request)
+    return api_response(request, api_cached(guild.id, "onduty", lambda: api_onduty_payload(guild)))
+
+async def api_leaderboard(request: web.Request):
+    guild = api_guild(request)
+    entry = api_cached(guild.id, "leaderboard", lambda: api_leaderboard_payload(guild), ttl=API_STATS_TTL)
+    return api_response(request, entry)
+
+async def api_user(request: web.Request):
+    guild = api_guild(request)
+    try:
+        user_id = int(request.match_info["user_id"])
+    except ValueError:
+        raise web.HTTPBadRequest(text='{"error":"bad user id"}', content_type="application/json")
+    # تجميعة وحدة لكل سيرفر كل API_STATS_TTL، وما نخزن شي بمفتاح id جاي من العميل
+    api_cached(guild.id, "leaderboard", lambda: api_leaderboard_payload(guild), ttl=API_STATS_TTL)
+    return api_response(request, api_entry(api_user_payload(guild, user_id)))
+
+async def api_metrics(request: web.Request):
+    return web.json_response({"ingest": ingest_snapshot(), "spam": {**spam_metrics, "buckets": len(_msg_buckets)}})
+
+async def start_api_server():
+    global _api_runner
+    if API_PORT == 0 or _api_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/api/guilds/{guild_id}/onduty", api_onduty)
+    app.router.add_get("/api/guilds/{guild_id}/leaderboard", api_leaderboard)
+    app.router.add_get("/api/guilds/{guild_id}/users/{user_id}", api_user)
+    app.router.add_get("/api/metrics", api_metrics)
+    _api_runner = web.AppRunner(app)
+    await _api_runner.setup()
+    await web.TCPSite(_api_runner, API_HOST, API_PORT).start()
+    print(f"✅ API running on http://{API_HOST}:{API_PORT}")
+
+# =======================
+# Profiling / slow callbacks
+# =======================
+PROFILE_DIR = "profiles"
+PROFILE_TOP_N = 30
+PROFILE_SIGNAL_SEC = 30  # مدة القياس لما يجي SIGUSR1
+SLOW_CALLBACK_SEC = float(os.getenv("SLOW_CALLBACK_SEC", "0.25") or 0)  # 0 = مقفل
+
+# 3.12+: cProfile يمشي على sys.monitoring ويغطي كل الـ threads، ويرفض بروفايلر ثاني وهو شغال
+PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+_profiling = False
+_profile_lock = asyncio.Lock()  # قياس واحد بس بنفس الوقت
+# قبل 3.12 cProfile يغطي thread واحد بس، فالشغل اللي يروح to_thread يسجل بروفايله هنا
+_thread_profiles: list[cProfile.Profile] = []
+_loop_beat = 0.0
+_watchdog_started = False
+
+def call_profiled(fn, *args):
+    if not _profiling or PROFILE_ALL_THREADS:
+        return fn(*args)
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # فيه أداة profiling ثانية شغالة: ننفذ بدون قياس بدل ما نضيع الكتابة
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        prof.disable()
+        _thread_profiles.append(prof)
+
+async def run_profile(seconds: int) -> tuple[str, str]:
+    # returns (report_path, raw_stats_path)
+    global _profiling
+    prof = cProfile.Profile()
+    _thread_profiles.clear()
+    _profiling = True
+    prof.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        prof.disable()
+        _profiling = False
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    raw_path = os.path.join(PROFILE_DIR, f"profile-{stamp}.prof")
+    report_path = os.path.join(PROFILE_DIR, f"profile-{stamp}.txt")
+
+    stats = pstats.Stats(prof)
+    for p in _thread_profiles:
+        stats.add(p)
+    _thread_profiles.clear()
+    stats.dump_stats(raw_path)
+
+    buf = io.StringIO()
+    stats.stream = buf
+    buf.write(f"Profile window: {seconds}s\n\n=== Top {PROFILE_TOP_N} by cumulative time ===\n")
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    buf.write(f"\n=== Top {PROFILE_TOP_N} by own time ===\n")
+    stats.sort_stats("tottime").print_stats(PROFILE_TOP_N)
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write(buf.getvalue())
+    return report_path, raw_path
+
+async def profile_from_signal():
+    # locked() + async with بدون await بينهم، فما فيه سباق
+    if _profile_lock.locked():
+        return
+    async with _profile_lock:
+        print(f"📈 SIGUSR1: profiling for {PROFILE_SIGNAL_SEC}s…")
+        report_path, raw_path = await run_profile(PROFILE_SIGNAL_SEC)
+    print(f"📈 Profile saved: {report_path} | {raw_path}")
+
+def install_profile_signal():
+    sig = getattr(signal, "SIGUSR1", None)
+    if sig is None:
+        return
+    try:
+        asyncio.get_running_loop().add_signal_handler(sig, lambda: asyncio.create_task(profile_from_signal()))
+    except (NotImplementedError, RuntimeError):
+        pass
+
+async def loop_heartbeat():
+    global _loop_beat
+    while True:
+        _loop_beat = time.monotonic()
+        await asyncio.sleep(SLOW_CALLBACK_SEC / 4)
+
+def slow_callback_watchdog(loop_thread_id: int):
+    # thread منفصل: لو الـ heartbeat تأخر أكثر من الحد، نطبع stack الـ loop وهو معلق
+    reported = 0.0
+    while True:
+        time.sleep(SLOW_CALLBACK_SEC / 4)
+        beat = _loop_beat
+        if not beat or beat == reported:
+            continue
+        lag = time.monotonic() - beat
+        if lag <= SLOW_CALLBACK_SEC:
+            continue
+        reported = beat
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+        print(f"🐢 Event loop blocked > {lag:.3f}s (limit {SLOW_CALLBACK_SEC}s):\n{stack}")
+
+def start_slow_callback_watchdog():
+    global _watchdog_started
+    if SLOW_CALLBACK_SEC <= 0 or _watchdog_started:
+        return
+    _watchdog_started = True
+    asyncio.create_task(loop_heartbeat())
+    threading.Thread(
+        target=slow_callback_watchdog,
+        args=(threading.get_ident(),),
+        name="slow-callback-watchdog",
+        daemon=True,
+    ).start()
+
+# =======================
+# Backups (sqlite online backup)
+# =======================
+BACKUP_DIR = "backups"
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_EVERY_HOURS = 6
+# النسخ يمشي بخطوات بس ما يوقف بينها (sleep بـ Connection.backup ينفع بس لما يرجع BUSY/LOCKED).
+# اللي يخليه ما يعطل شي: يشتغل في thread، وبـ WAL القراءة ما تمنع الكتابة.
+# ما نبطئه عمدًا: أي كتابة من اتصال ثاني أثناء النسخ تخلي sqlite يعيده من الأول.
+BACKUP_PAGES_PER_STEP = 256
+
+_backup_lock = asyncio.Lock()
+
+def check_integrity(path: str) -> str:
+    con = sqlite3.connect(path)
+    try:
+        return str(con.execute("PRAGMA integrity_check").fetchone()[0])
+    finally:
+        con.close()
+
+def rotate_backups():
+    files = sorted(
+        f for f in os.listdir(BACKUP_DIR)
+        if f.startswith("staff_duty-") and f.endswith(".db.gz")
+    )
+    if BACKUP_KEEP <= 0:
+        return
+    for f in files[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, f))
+
+def make_backup(rotate: bool = True) -> str:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    tmp_path = os.path.join(BACKUP_DIR, f".staff_duty-{stamp}.db.tmp")
+    out_path = os.path.join(BACKUP_DIR, f"staff_duty-{stamp}.db.gz")
+    try:
+        src = db()
+        dst = sqlite3.connect(tmp_path)
+        try:
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP)
+        finally:
+            dst.close()
+            src.close()
+
+        result = check_integrity(tmp_path)
+        if result != "ok":
+            raise RuntimeError(f"backup integrity check failed: {result}")
+
+        with open(tmp_path, "rb") as f, gzip.open(out_path + ".part", "wb") as g:
+            shutil.copyfileobj(f, g)
+        os.replace(out_path + ".part", out_path)
+    finally:
+        for leftover in (tmp_path, out_path + ".part"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    if rotate:
+        rotate_backups()
+    return out_path
+
+async def run_backup() -> str:
+    # النسخ كله في thread، فالـ event loop ما يتعطل ولا خطوة
+    async with _backup_lock:
+        return await asyncio.to_thread(make_backup)
+
+@tasks.loop(hours=BACKUP_EVERY_HOURS)
+async def backup_loop():
+    try:
+        path = await run_backup()
+        print(f"💾 Backup saved: {path}")
+    except Exception as e:
+        print("❌ Backup error:", e)
+
+def unpack_backup(path: str, dest_path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f, open(dest_path, "wb") as out:
+        shutil.copyfileobj(f, out)
+
+def restore_backup(path: str):
+    # لازم البوت يكون طافي. نفك الضغط لملف مؤقت، نتأكد من سلامته، وبعدين ننسخه فوق DB_PATH
+    tmp_path = DB_PATH + ".restore"
+    try:
+        unpack_backup(path, tmp_path)
+        result = check_integrity(tmp_path)
+        if result != "ok":
+            raise SystemExit(f"❌ الباك أب خربان: {result}")
+
+        if os.path.exists(DB_PATH):
+            # بدون rotate: ممكن نكون نسترجع من أقدم نسخة، والتدوير بيحذفها
+            print(f"💾 نسخة احتياطية قبل الاسترجاع: {make_backup(rotate=False)}")
+
+        src = sqlite3.connect(tmp_path)
+        dst = db()
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"✅ تم الاسترجاع من {path}")
+
 # =======================
 # SLASH (ADMIN SETUP)
 # =======================
@@ -787,12 +1939,65 @@ async def setup_weekly(inter: discord.Interaction, weekly_channel: discord.TextC
     set_setting(inter.guild.id, "weekly_channel_id", weekly_channel.id)
     set_setting(inter.guild.id, "staff_week_role_id", staff_week_role.id)
 
+    s = get_settings(inter.guild.id)
     await inter.response.send_message(
         "✅ تم ضبط التقرير الأسبوعي.\n"
-        "📅 ينزل كل **جمعة 8:00 مساءً** بتوقيت الرياض.",
+        f"📅 ينزل كل **{WEEKDAYS_AR[int(s['report_weekday'])]} {int(s['report_hour']):02d}:00** بتوقيت `{s['tz_name']}`.",
         ephemeral=True
     )
 
+@bot.tree.command(name="set_timezone", description="Set server timezone for day keys + weekly report (Admin)")
+@app_commands.describe(tz="اسم المنطقة الزمنية (مثال Asia/Riyadh أو Europe/London)")
+async def set_timezone(inter: discord.Interaction, tz: str):
+    if not inter.guild:
+        return await inter.response.send_message("داخل سيرفر فقط.", ephemeral=True)
+    if not is_admin(inter):
+        return await inter.response.send_message("❌ Admin فقط.", ephemeral=True)
+    if load_tz(tz) is None:
+        return await inter.response.send_message(f"❌ منطقة زمنية غير معروفة: `{tz}`", ephemeral=True)
+
+    set_setting(inter.guild.id, "tz_name", tz)
+    now = guild_now(inter.guild.id)
+    await inter.response.send_message(f"✅ تم ضبط التوقيت: `{tz}` (الوقت الحين {now:%Y-%m-%d %H:%M})", ephemeral=True)
+
+@bot.tree.command(name="set_report_time", description="Set weekly report day + hour (Admin)")
+@app_commands.describe(day="يوم التقرير", hour="الساعة (0-23) بتوقيت السيرفر")
+@app_commands.choices(day=[app_commands.Choice(name=name, value=i) for i, name in enumerate(WEEKDAYS_AR)])
+async def set_report_time(inter: discord.Interaction, day: app_commands.Choice[int], hour: app_commands.Range[int, 0, 23]):
+    if not inter.guild:
+        return await inter.response.send_message("داخل سيرفر فقط.", ephemeral=True)
+    if not is_admin(inter):
+        return await inter.response.send_message("❌ Admin فقط.", ephemeral=True)
+
+    set_setting(inter.guild.id, "report_weekday", int(day.value))
+    set_setting(inter.guild.id, "report_hour", int(hour))
+    await inter.response.send_message(f"✅ التقرير الأسبوعي صار كل **{day.name} {int(hour):02d}:00**.", ephemeral=True)
+
+@bot.tree.command(name="set_msg_limits", description="Set message counting limits per user (Admin)")
+@app_commands.describe(
+    per_minute="كم رسالة تنحسب بالدقيقة (0 = بدون حد)",
+    burst="كم رسالة ورا بعض تنحسب قبل ما يبدأ الحد",
+    dup_window="الرسالة المكررة خلال كم ثانية ما تنحسب (0 = مقفل)",
+)
+async def set_msg_limits(
+    inter: discord.Interaction,
+    per_minute: app_commands.Range[int, 0, 120],
+    burst: app_commands.Range[int, 1, 60],
+    dup_window: app_commands.Range[int, 0, 3600],
+):
+    if not inter.guild:
+        return await inter.response.send_message("داخل سيرفر فقط.", ephemeral=True)
+    if not is_admin(inter):
+        return await inter.response.send_message("❌ Admin فقط.", ephemeral=True)
+
+    set_setting(inter.guild.id, "msg_rate_per_min", int(per_minute))
+    set_setting(inter.guild.id, "msg_burst", int(burst))
+    set_setting(inter.guild.id, "dup_window_sec", int(dup_window))
+    await inter.response.send_message(
+        f"✅ حد عدّ الرسائل: **{per_minute}/دقيقة** (burst {burst}) | فلتر التكرار: **{dup_window}s**",
+        ephemeral=True,
+    )
+
 @bot.tree.command(name="set_alert_channel", description="Set emergency alert channel (Admin)")
 @app_commands.describe(channel="روم نداء الطوارئ")
 async def set_alert_channel(inter: discord.Interaction, channel: discord.TextChannel):
@@ -827,7 +2032,8 @@ async def post_duty_panel(inter: discord.Interaction, channel: discord.TextChann
     if not staff_role or not onduty_role:
         return await inter.response.send_message("❌ سو /setup_duty أول.", ephemeral=True)
 
-    await channel.send(embed=build_dashboard_embed(inter.guild), view=DutyPanelView())
+    msg = await channel.send(embeds=dashboard_embeds(inter.guild), view=DutyPanelView())
+    remember_panel(inter.guild.id, channel.id, msg.id)
     await inter.response.send_message(f"✅ تم نشر لوحة الحضور في {channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="weekly_now", description="Send weekly report now (Owner only)")
@@ -840,6 +2046,67 @@ async def weekly_now(inter: discord.Interaction):
     await run_weekly_report_for_guild(inter.guild)
     await inter.response.send_message("✅ تم إرسال التقرير الأسبوعي يدويًا.", ephemeral=True)
 
+@bot.tree.command(name="backup_now", description="Take a database backup now (Bot owner only)")
+async def backup_now(inter: discord.Interaction):
+    if not await bot.is_owner(inter.user):
+        return await inter.response.send_message("❌ هذا الأمر لمالك البوت فقط.", ephemeral=True)
+
+    await inter.response.defer(ephemeral=True, thinking=True)
+    try:
+        path = await run_backup()
+    except Exception as e:
+        return await inter.followup.send(f"❌ فشل الباك أب: {e}", ephemeral=True)
+    size_kb = os.path.getsize(path) // 1024
+    await inter.followup.send(f"💾 تم الباك أب: `{path}` ({size_kb} KB)", ephemeral=True)
+
+@bot.tree.command(name="profile", description="Profile handlers/loops/DB for N seconds (Bot owner only)")
+@app_commands.describe(seconds="مدة القياس بالثواني")
+async def profile_cmd(inter: discord.Interaction, seconds: app_commands.Range[int, 5, 300]):
+    if not await bot.is_owner(inter.user):
+        return await inter.response.send_message("❌ هذا الأمر لمالك البوت فقط.", ephemeral=True)
+    if _profile_lock.locked():
+        return await inter.response.send_message("⏳ فيه قياس شغال الحين.", ephemeral=True)
+
+    # نمسك القفل قبل أول await عشان طلبين مع بعض ما يعدون الفحص
+    async with _profile_lock:
+        await inter.response.defer(ephemeral=True, thinking=True)
+        report_path, raw_path = await run_profile(int(seconds))
+    await inter.followup.send(
+        f"📈 Profile ({seconds}s) — أعلى {PROFILE_TOP_N} دالة + ملف pstats الخام.",
+        files=[discord.File(report_path), discord.File(raw_path)],
+        ephemeral=True,
+    )
+
+# =======================
+# SLASH (STATS)
+# =======================
+PERIOD_CHOICES = [app_commands.Choice(name=label, value=key) for key, label in PERIOD_LABELS.items()]
+
+@bot.tree.command(name="my_stats", description="Your duty hours + session history")
+@app_commands.describe(period="الفترة")
+@app_commands.choices(period=PERIOD_CHOICES)
+async def my_stats(inter: discord.Interaction, period: app_commands.Choice[str] | None = None):
+    if not inter.guild:
+        return await inter.response.send_message("داخل سيرفر فقط.", ephemeral=True)
+
+    staff_role, _, _ = get_roles(inter.guild)
+    member: discord.Member = inter.user  # type: ignore
+    if not (is_admin(inter) or is_staff_member(member, staff_role)):
+        return await inter.response.send_message("❌ للستاف فقط.", ephemeral=True)
+
+    await send_user_stats(inter, member, period.value if period else "week")
+
+@bot.tree.command(name="staff_stats", description="Duty hours + session history for a staff member (Admin)")
+@app_commands.describe(user="الإداري", period="الفترة")
+@app_commands.choices(period=PERIOD_CHOICES)
+async def staff_stats(inter: discord.Interaction, user: discord.Member, period: app_commands.Choice[str] | None = None):
+    if not inter.guild:
+        return await inter.response.send_message("داخل سيرفر فقط.", ephemeral=True)
+    if not is_admin(inter):
+        return await inter.response.send_message("❌ Admin فقط.", ephemeral=True)
+
+    await send_user_stats(inter, user, period.value if period else "week")
+
 # =======================
 # READY
 # =======================
@@ -848,6 +2115,11 @@ async def on_ready():
     print(f"✅ Logged in as {bot.user} (ID: {bot.user.id})")
     try:
         bot.add_view(DutyPanelView())
+        start_ingest_worker()
+        for guild in bot.guilds:
+            await reconcile_duty_roles(guild)
+        start_slow_callback_watchdog()
+        install_profile_signal()
         synced = await bot.tree.sync()
         print(f"✅ Synced {len(synced)} slash commands")
 
@@ -855,6 +2127,11 @@ async def on_ready():
             weekly_scheduler.start()
         if not auto_clockout_loop.is_running():
             auto_clockout_loop.start()
+        if not backup_loop.is_running():
+            backup_loop.start()
+        if not msg_bucket_gc.is_running():
+            msg_bucket_gc.start()
+        await start_api_server()
 
         print("✅ Ready + weekly scheduler running + auto-clockout running")
     except Exception as e:
@@ -863,7 +2140,25 @@ async def on_ready():
 # =======================
 # RUN
 # =======================
+if CLI_MODE:
+    if len(sys.argv) < 3:
+        raise SystemExit(f"usage: python {sys.argv[0]} {sys.argv[1]} <backup.db.gz>")
+    if sys.argv[1] == "--verify-backup":
+        tmp_path = DB_PATH + ".verify"
+        try:
+            unpack_backup(sys.argv[2], tmp_path)
+            result = check_integrity(tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"integrity_check: {result}")
+        raise SystemExit(0 if result == "ok" else 1)
+    restore_backup(sys.argv[2])
+    raise SystemExit(0)
+
 init_db()
+load_duty_state()
+load_panels()
 
 
 